@@ -227,13 +227,7 @@ def render_mini_voice_agent():
     from voice_agent_components import (
         initialize_voice_agent,
         get_azure_client,
-        handle_voice_input,
-        render_input_ui,
-        handle_text_input,
-        render_send_button,
-        generate_ai_response,
-        display_chat_history,
-        render_audio_player
+        render_voice_chat
     )
     
     with st.expander("ユーザーエージェント（音声チャット）", expanded=False):
@@ -248,38 +242,8 @@ def render_mini_voice_agent():
             return
         gpt_client, voice_client, GPT_DEPLOYMENT_NAME, STT_DEPLOYMENT_NAME, tts_config = result
         
-        # 入力UI
-        col1, col2 = st.columns([1, 1])
-        
-        with col1:
-            user_text = render_input_ui()
-        
-        with col2:
-            transcribed_text = handle_voice_input(voice_client, STT_DEPLOYMENT_NAME)
-        
-        # 最終的な入力の決定
-        final_input = handle_text_input(user_text, transcribed_text)
-        
-        # 送信UI
-        send = render_send_button()
-        
-        # AI応答処理
-        if send and final_input and final_input.strip():
-            st.session_state["voice_agent_messages"].append({"role": "user", "content": final_input.strip()})
-            
-            # AI応答生成 + TTS音声生成（GPTクライアント使用 - East US 2）
-            ai_reply, audio_data = generate_ai_response(gpt_client, GPT_DEPLOYMENT_NAME, final_input, tts_config)
-            
-            if ai_reply:
-                st.session_state["voice_agent_messages"].append({"role": "assistant", "content": ai_reply})
-                st.success(ai_reply)
-                
-                # 音声再生UI
-                if audio_data:
-                    render_audio_player(audio_data)
-        
-        # チャット履歴表示
-        display_chat_history()
+        # 入力〜応答〜履歴表示（フラグメントなので操作時もアプリ全体は再実行されない）
+        render_voice_chat(gpt_client, voice_client, GPT_DEPLOYMENT_NAME, STT_DEPLOYMENT_NAME, tts_config)
 
 
 if __name__ == "__main__":
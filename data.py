@@ -2,10 +2,66 @@
 
 import streamlit as st
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import atexit
 import json
 import os
+import threading
 from typing import Any, Dict, List
 
+# =============== バックグラウンド書き込み ===============
+
+# ディスクへのJSON書き込みを UI スレッドから切り離すための専用スレッド
+# (ワーカーは1つにして、同じファイルへの書き込み順序を保証する)
+_IO_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="json_writer")
+atexit.register(lambda: _IO_POOL.shutdown(wait=True))
+
+_pending_writes: Dict[str, Future] = {}
+_pending_writes_lock = threading.Lock()
+
+
+def _write_text_atomic(path: str, text: str):
+    """一時ファイルに書いてから置き換える (読み込み側が書きかけのファイルを見ないように)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json_async(path: str, data: Any, indent: int = 4) -> Future:
+    """
+    JSONデータをバックグラウンドでファイルに書き込む
+    
+    シリアライズは呼び出し元のスレッドで行うため、戻った後に data を変更しても
+    書き込み内容には影響しない。
+    
+    Returns:
+        書き込み完了を表す Future
+    """
+    text = json.dumps(data, ensure_ascii=False, indent=indent)
+    with _pending_writes_lock:
+        future = _IO_POOL.submit(_write_text_atomic, path, text)
+        _pending_writes[path] = future
+    future.add_done_callback(lambda f: _log_write_error(f, path))
+    return future
+
+
+def _log_write_error(future: Future, path: str):
+    """バックグラウンド書き込みの失敗をログに記録"""
+    error = future.exception()
+    if error is not None:
+        from logger import log_error
+        # ワーカースレッドからは画面に表示できないため、ログのみに記録する
+        log_error(error, "JSON_WRITE", show_user=False, details={"path": path})
+
+
+def wait_for_pending_write(path: str):
+    """指定ファイルへの未完了の書き込みがあれば完了を待つ (書き込み直後の読み込み用)"""
+    with _pending_writes_lock:
+        future = _pending_writes.pop(path, None)
+    if future is not None:
+        wait([future])
+
 def initialize_session_state():
     # セッションステートを初期化する関数
     if 'subjects' not in st.session_state:
@@ -206,14 +262,19 @@ def record_grade(subject, grade_type, grade, weight, comment):
 
 def load_grades():
     # 成績データをファイルから読み込む関数
+    wait_for_pending_write('grades.json')
     if os.path.exists('grades.json'):
         with open('grades.json', 'r', encoding='utf-8') as f:
             st.session_state.grades = json.load(f)
     else:
         st.session_state.grades = {}
 
-def save_grades():
+def save_grades(background: bool = False):
     # 成績データをファイルに保存する関数
+    # background=True の場合はディスク書き込みを待たずに戻る
+    if background:
+        return write_json_async('grades.json', st.session_state.grades)
+    wait_for_pending_write('grades.json')
     with open('grades.json', 'w', encoding='utf-8') as f:
         json.dump(st.session_state.grades, f, ensure_ascii=False, indent=4)
 
@@ -291,9 +352,13 @@ def get_user_profile():
         load_user_profile()
     return st.session_state.user_profile
 
+# 学歴の選択肢（固定値なのでモジュール読み込み時に一度だけ作成）
+EDUCATION_LEVELS = ("小学生", "中学生", "高校生", "大学生", "大学院生")
+EDUCATION_LEVEL_INDEX = {level: i for i, level in enumerate(EDUCATION_LEVELS)}
+
 def get_education_levels():
     """学歴の選択肢を返す"""
-    return ["小学生", "中学生", "高校生", "大学生", "大学院生"]
+    return EDUCATION_LEVELS
 
 # =============== リマインダー管理機能 ===============
 
@@ -6,9 +6,12 @@ import pandas as pd
 from data import (
     add_subject, load_subjects, get_latest_grades, get_total_study_time, 
     get_motivation_data, get_all_grades_data, get_user_profile, 
-    update_user_profile, get_education_levels
+    update_user_profile, EDUCATION_LEVELS, EDUCATION_LEVEL_INDEX
 )
 
+# 学歴が未設定・不明な場合の初期選択（高校生）
+DEFAULT_EDUCATION_INDEX = 2
+
 def register_subject():
     # セッションステートの初期化
     if 'subjects' not in st.session_state:
@@ -48,13 +51,12 @@ def register_subject():
                 help="あなたの現在の年齢を入力してください"
             )
             
-            education_levels = get_education_levels()
             current_education = profile.get("education_level")
-            default_index = education_levels.index(current_education) if current_education in education_levels else 2
+            default_index = EDUCATION_LEVEL_INDEX.get(current_education, DEFAULT_EDUCATION_INDEX)
             
             education_input = st.selectbox(
                 "学歴",
-                options=education_levels,
+                options=EDUCATION_LEVELS,
                 index=default_index,
                 help="あなたの現在の学歴を選択してください"
             )
@@ -120,7 +122,7 @@ def register_subject():
         # 各科目の最新5回分のデータのみを取得
         for subject, grades_list in all_grades_data.items():
             # 最新5回分のみを使用
-            recent_grades = grades_list[-5:] if len(grades_list) >= 5 else grades_list
+            recent_grades = grades_list[-5:]
             for i, g in enumerate(recent_grades, 1):
                 all_records.append({
                     "subject": subject,
@@ -1,70 +1,214 @@
 # templates.py - テンプレート機能
 
 import streamlit as st
+import pandas as pd
 import json
 import os
+import sqlite3
+import threading
+import uuid
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Tuple
 from data import save_grades, save_progress
 from logger import log_info, log_error
 
-# テンプレートファイルのパス
+# テンプレートの保存先 (SQLite)
+TEMPLATES_DB_FILE = "templates.db"
+
+# 旧形式 (カテゴリ別JSON) のファイル。初回起動時に SQLite へ取り込む
 GRADE_TEMPLATES_FILE = "grade_templates.json"
 PLAN_TEMPLATES_FILE = "plan_templates.json"
 
+# テンプレートのカテゴリ
+GRADE_CATEGORY = "grade"
+PLAN_CATEGORY = "plan"
+
+# 成績テンプレートで選べる成績の種類
+GRADE_TYPE_OPTIONS = ["テスト", "課題", "小テスト", "その他"]
+
+# スキーマのバージョン (PRAGMA user_version)
+_SCHEMA_VERSION = 1
+
+# 複数セッションから同じ接続を使うため、SQL の実行はロックで直列化する
+_db_lock = threading.Lock()
+
+# カテゴリごとの更新カウンタ (読み込みキャッシュのキー。書き込みのたびに進める)
+_templates_version: Dict[str, int] = {GRADE_CATEGORY: 0, PLAN_CATEGORY: 0}
+
 
 # =========================
-# テンプレートファイルの読み込み・保存
+# テンプレートの読み込み・保存
 # =========================
 
+@st.cache_resource
+def _get_templates_db() -> sqlite3.Connection:
+    """テンプレートDBへの接続を取得 (プロセス内で1つだけ作成)"""
+    conn = sqlite3.connect(TEMPLATES_DB_FILE, check_same_thread=False)
+    with _db_lock, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS templates ("
+            " id TEXT NOT NULL,"
+            " category TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " json TEXT NOT NULL,"
+            " created_at TEXT NOT NULL,"
+            " PRIMARY KEY (category, id))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_templates_category_name ON templates (category, name)")
+        
+        if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+            grade_ok = _import_json_templates(conn, GRADE_CATEGORY, GRADE_TEMPLATES_FILE)
+            plan_ok = _import_json_templates(conn, PLAN_CATEGORY, PLAN_TEMPLATES_FILE)
+            # 移行に失敗した場合は次回起動時に再試行する (取り込み済みの行は INSERT OR IGNORE で重複しない)
+            if grade_ok and plan_ok:
+                conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+    return conn
+
+
+def _import_json_templates(conn: sqlite3.Connection, category: str, path: str) -> bool:
+    """旧形式のJSONファイルからテンプレートを取り込む (失敗した場合は False)"""
+    if not os.path.exists(path):
+        return True
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            templates = json.load(f)
+        conn.executemany(
+            "INSERT OR IGNORE INTO templates VALUES (?, ?, ?, ?, ?)",
+            [_template_row(category, t) for t in templates]
+        )
+        log_info(f"テンプレート移行成功 ({path}): {len(templates)}件", "TEMPLATES")
+        return True
+    except Exception as e:
+        log_error(e, f"テンプレート移行エラー ({path})")
+        return False
+
+
+def _template_row(category: str, template: Dict[str, Any]) -> Tuple[str, str, str, str, str]:
+    """テンプレートを templates テーブルの1行に変換"""
+    return (
+        template['id'],
+        category,
+        template['name'],
+        json.dumps(template, ensure_ascii=False),
+        template.get('created_at', '')
+    )
+
+
+@st.cache_data(show_spinner=False)
+def _load_templates(category: str, version: int) -> List[Dict[str, Any]]:
+    """カテゴリのテンプレートを作成順に読み込む (version は書き込みで無効化するためのキー)"""
+    conn = _get_templates_db()
+    with _db_lock:
+        rows = conn.execute(
+            "SELECT json FROM templates WHERE category = ? ORDER BY created_at, rowid",
+            (category,)
+        ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def _save_template(category: str, template: Dict[str, Any]):
+    """テンプレートを1件追加 (同じIDが既にあれば sqlite3.IntegrityError)"""
+    conn = _get_templates_db()
+    with _db_lock, conn:
+        conn.execute("INSERT INTO templates VALUES (?, ?, ?, ?, ?)", _template_row(category, template))
+        _templates_version[category] += 1
+
+
+def _delete_template(category: str, template_id: str):
+    """テンプレートを1件削除"""
+    conn = _get_templates_db()
+    with _db_lock, conn:
+        conn.execute("DELETE FROM templates WHERE category = ? AND id = ?", (category, template_id))
+        _templates_version[category] += 1
+
+
 def load_grade_templates() -> List[Dict[str, Any]]:
     """成績テンプレートを読み込む"""
-    if os.path.exists(GRADE_TEMPLATES_FILE):
-        try:
-            with open(GRADE_TEMPLATES_FILE, 'r', encoding='utf-8') as f:
-                templates = json.load(f)
-                log_info(f"成績テンプレート読み込み成功: {len(templates)}件", "TEMPLATES")
-                return templates
-        except Exception as e:
-            log_error(e, "成績テンプレート読み込みエラー")
-            return []
-    return []
-
-
-def save_grade_templates(templates: List[Dict[str, Any]]):
-    """成績テンプレートを保存"""
     try:
-        with open(GRADE_TEMPLATES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(templates, f, ensure_ascii=False, indent=2)
-        log_info(f"成績テンプレート保存成功: {len(templates)}件", "TEMPLATES")
+        return _load_templates(GRADE_CATEGORY, _templates_version[GRADE_CATEGORY])
+    except Exception as e:
+        log_error(e, "成績テンプレート読み込みエラー")
+        return []
+
+
+def save_grade_template(template: Dict[str, Any]):
+    """成績テンプレートを1件保存"""
+    try:
+        _save_template(GRADE_CATEGORY, template)
+        log_info(f"成績テンプレート保存成功: {template['name']}", "TEMPLATES")
     except Exception as e:
         log_error(e, "成績テンプレート保存エラー")
 
 
+def delete_grade_template(template_id: str):
+    """成績テンプレートを1件削除"""
+    try:
+        _delete_template(GRADE_CATEGORY, template_id)
+        log_info(f"成績テンプレート削除成功: {template_id}", "TEMPLATES")
+    except Exception as e:
+        log_error(e, "成績テンプレート削除エラー")
+
+
+def load_grade_templates_indexed() -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """成績テンプレートを読み込み、(一覧, 名前→テンプレートの索引) を返す"""
+    templates = load_grade_templates()
+    return templates, index_templates_by_name(templates)
+
+
 def load_plan_templates() -> List[Dict[str, Any]]:
     """学習計画テンプレートを読み込む"""
-    if os.path.exists(PLAN_TEMPLATES_FILE):
-        try:
-            with open(PLAN_TEMPLATES_FILE, 'r', encoding='utf-8') as f:
-                templates = json.load(f)
-                log_info(f"学習計画テンプレート読み込み成功: {len(templates)}件", "TEMPLATES")
-                return templates
-        except Exception as e:
-            log_error(e, "学習計画テンプレート読み込みエラー")
-            return []
-    return []
-
-
-def save_plan_templates(templates: List[Dict[str, Any]]):
-    """学習計画テンプレートを保存"""
     try:
-        with open(PLAN_TEMPLATES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(templates, f, ensure_ascii=False, indent=2)
-        log_info(f"学習計画テンプレート保存成功: {len(templates)}件", "TEMPLATES")
+        return _load_templates(PLAN_CATEGORY, _templates_version[PLAN_CATEGORY])
+    except Exception as e:
+        log_error(e, "学習計画テンプレート読み込みエラー")
+        return []
+
+
+def save_plan_template(template: Dict[str, Any]):
+    """学習計画テンプレートを1件保存"""
+    try:
+        _save_template(PLAN_CATEGORY, template)
+        log_info(f"学習計画テンプレート保存成功: {template['name']}", "TEMPLATES")
     except Exception as e:
         log_error(e, "学習計画テンプレート保存エラー")
 
 
+def delete_plan_template(template_id: str):
+    """学習計画テンプレートを1件削除"""
+    try:
+        _delete_template(PLAN_CATEGORY, template_id)
+        log_info(f"学習計画テンプレート削除成功: {template_id}", "TEMPLATES")
+    except Exception as e:
+        log_error(e, "学習計画テンプレート削除エラー")
+
+
+def load_plan_templates_indexed() -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """学習計画テンプレートを読み込み、(一覧, 名前→テンプレートの索引) を返す"""
+    templates = load_plan_templates()
+    return templates, index_templates_by_name(templates)
+
+
+def index_templates_by_name(templates: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    テンプレート名からテンプレートを引く索引を作成
+    
+    同名のテンプレートが複数ある場合は、一覧で先に現れるものを優先する
+    (従来の線形探索と同じ結果になる)。
+    """
+    templates_by_name: Dict[str, Dict[str, Any]] = {}
+    for template in templates:
+        templates_by_name.setdefault(template['name'], template)
+    return templates_by_name
+
+
+def plan_items_dataframe(items: List[Dict[str, Any]]) -> pd.DataFrame:
+    """学習項目を表示用のDataFrameに変換"""
+    return pd.DataFrame([
+        {"科目": item['subject'], "内容": item['content'], "時間": item['duration']}
+        for item in items
+    ])
+
+
 # =========================
 # メイン機能
 # =========================
@@ -123,41 +267,38 @@ def create_grade_template():
     selected_subjects = st.multiselect(
         "テンプレートに含める科目",
         options=st.session_state.subjects,
-        default=st.session_state.subjects[:3] if len(st.session_state.subjects) >= 3 else st.session_state.subjects
+        default=st.session_state.subjects[:3]
     )
     
     if not selected_subjects:
         st.info("💡 科目を選択してください。")
         return
     
-    # 各科目の設定
+    # 各科目の設定 (全科目を1つのデータエディタで編集)
     st.markdown("#### ⚙️ 各科目の設定")
-    subject_settings = []
-    
-    for subject in selected_subjects:
-        with st.expander(f"📖 {subject} の設定"):
-            col1, col2 = st.columns(2)
-            with col1:
-                grade_type = st.selectbox(
-                    "成績の種類",
-                    options=["テスト", "課題", "小テスト", "その他"],
-                    key=f"type_{subject}"
-                )
-            with col2:
-                weight = st.number_input(
-                    "重み",
-                    min_value=0.1,
-                    max_value=10.0,
-                    value=1.0,
-                    step=0.1,
-                    key=f"weight_{subject}"
-                )
-            
-            subject_settings.append({
-                "subject": subject,
-                "grade_type": grade_type,
-                "weight": weight
-            })
+    settings_df = pd.DataFrame([
+        {"subject": subject, "grade_type": "テスト", "weight": 1.0}
+        for subject in selected_subjects
+    ])
+    
+    edited_settings_df = st.data_editor(
+        settings_df,
+        use_container_width=True,
+        num_rows="fixed",
+        column_config={
+            "subject": st.column_config.TextColumn("科目"),
+            "grade_type": st.column_config.SelectboxColumn(
+                "成績の種類",
+                options=GRADE_TYPE_OPTIONS,
+                required=True
+            ),
+            "weight": st.column_config.NumberColumn("重み", min_value=0.1, max_value=10.0, step=0.1, required=True)
+        },
+        disabled=["subject"],
+        hide_index=True
+    )
+    
+    subject_settings = edited_settings_df.to_dict('records')
     
     # テンプレート保存
     if st.button("💾 テンプレートを保存", type="primary", key="save_grade_template_btn"):
@@ -166,16 +307,14 @@ def create_grade_template():
             return
         
         template = {
-            "id": datetime.now().strftime("%Y%m%d_%H%M%S"),
+            "id": str(uuid.uuid4()),
             "name": template_name,
             "description": template_description,
             "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "subjects": subject_settings
         }
         
-        templates = load_grade_templates()
-        templates.append(template)
-        save_grade_templates(templates)
+        save_grade_template(template)
         
         st.success(f"✅ テンプレート「{template_name}」を保存しました!")
         log_info(f"成績テンプレート作成: {template_name} ({len(subject_settings)}科目)", "TEMPLATES")
@@ -185,21 +324,21 @@ def use_grade_template():
     """テンプレートから成績を入力"""
     st.markdown("### ✨ テンプレートから一括入力")
     
-    templates = load_grade_templates()
+    templates, templates_by_name = load_grade_templates_indexed()
     
     if not templates:
         st.info("💡 テンプレートが登録されていません。「テンプレート作成」タブから作成してください。")
         return
     
     # テンプレート選択
-    template_names = [t['name'] for t in templates]
+    template_names = list(templates_by_name)
     selected_template_name = st.selectbox("使用するテンプレート", options=template_names)
     
     if not selected_template_name:
         return
     
     # 選択されたテンプレートを取得
-    selected_template = next((t for t in templates if t['name'] == selected_template_name), None)
+    selected_template = templates_by_name.get(selected_template_name)
     
     if not selected_template:
         st.error("❌ テンプレートの読み込みに失敗しました。")
@@ -219,34 +358,43 @@ def use_grade_template():
     # 各科目の点数入力
     st.markdown("#### 📊 各科目の点数を入力")
     
+    # 科目ごとの入力欄を1つのデータエディタにまとめる (科目数に比例してウィジェットを増やさない)
+    grade_df = pd.DataFrame([
+        {
+            "科目": subject_setting['subject'],
+            "種類": subject_setting['grade_type'],
+            "重み": subject_setting['weight'],
+            "点数": 0
+        }
+        for subject_setting in selected_template['subjects']
+    ])
+    
+    edited_grade_df = st.data_editor(
+        grade_df,
+        use_container_width=True,
+        num_rows="fixed",
+        column_config={
+            "科目": st.column_config.TextColumn("科目", disabled=True),
+            "種類": st.column_config.TextColumn("種類", disabled=True),
+            "重み": st.column_config.NumberColumn("重み", disabled=True),
+            "点数": st.column_config.NumberColumn("点数", min_value=0, max_value=100, step=1, required=True)
+        },
+        hide_index=True,
+        key=f"grade_template_editor_{selected_template['id']}"
+    )
+    
+    # 0点 (未入力) の科目は登録対象から外しておく
     grade_inputs = []
     
-    for subject_setting in selected_template['subjects']:
-        subject = subject_setting['subject']
-        grade_type = subject_setting['grade_type']
-        weight = subject_setting['weight']
-        
-        col1, col2, col3 = st.columns([2, 2, 3])
-        with col1:
-            st.markdown(f"**{subject}**")
-        with col2:
-            st.markdown(f"({grade_type}, 重み: {weight})")
-        with col3:
-            grade = st.number_input(
-                "点数",
-                min_value=0,
-                max_value=100,
-                value=0,
-                step=1,
-                key=f"grade_{subject}",
-                label_visibility="collapsed"
-            )
-            
+    for row in edited_grade_df.to_dict('records'):
+        # 空欄にされたセルは NaN になるため 0 点 (未入力) として扱う
+        grade = 0 if pd.isna(row["点数"]) else int(row["点数"])
+        if grade > 0:
             grade_inputs.append({
-                "subject": subject,
+                "subject": row["科目"],
                 "grade": grade,
-                "grade_type": grade_type,
-                "weight": weight
+                "grade_type": row["種類"],
+                "weight": row["重み"]
             })
     
     # コメント入力
@@ -265,10 +413,6 @@ def use_grade_template():
             grade_type = grade_input['grade_type']
             weight = grade_input['weight']
             
-            # 0点の科目はスキップするか確認
-            if grade == 0:
-                continue
-            
             # 科目がまだない場合は初期化
             if subject not in st.session_state.grades:
                 st.session_state.grades[subject] = []
@@ -284,8 +428,8 @@ def use_grade_template():
             
             registered_count += 1
         
-        # 保存
-        save_grades()
+        # 保存 (ディスク書き込みは待たずに結果を表示)
+        save_grades(background=True)
         
         st.success(f"✅ {registered_count}科目の成績を一括登録しました!")
         log_info(f"テンプレート使用: {selected_template['name']} - {registered_count}科目登録", "TEMPLATES")
@@ -302,7 +446,7 @@ def manage_grade_templates():
         return
     
     # テンプレート一覧表示
-    for i, template in enumerate(templates):
+    for template in templates:
         with st.expander(f"📋 {template['name']} ({len(template['subjects'])}科目)"):
             st.markdown(f"**ID**: {template['id']}")
             st.markdown(f"**作成日時**: {template['created_at']}")
@@ -310,13 +454,14 @@ def manage_grade_templates():
                 st.markdown(f"**説明**: {template['description']}")
             
             st.markdown("**科目設定**:")
-            for subject_setting in template['subjects']:
-                st.markdown(f"- {subject_setting['subject']}: {subject_setting['grade_type']} (重み: {subject_setting['weight']})")
+            st.table(pd.DataFrame([
+                {"科目": s['subject'], "種類": s['grade_type'], "重み": s['weight']}
+                for s in template['subjects']
+            ]))
             
             # 削除ボタン
-            if st.button(f"🗑️ このテンプレートを削除", key=f"delete_grade_template_{i}"):
-                templates.pop(i)
-                save_grade_templates(templates)
+            if st.button(f"🗑️ このテンプレートを削除", key=f"delete_grade_template_{template['id']}"):
+                delete_grade_template(template['id'])
                 st.success(f"✅ テンプレート「{template['name']}」を削除しました。")
                 st.rerun()
 
@@ -387,18 +532,38 @@ def create_plan_template():
     # 現在の項目一覧
     if st.session_state.plan_template_items:
         st.markdown("#### 📋 現在の学習項目")
-        for i, item in enumerate(st.session_state.plan_template_items):
-            col1, col2, col3, col4 = st.columns([2, 3, 1, 1])
-            with col1:
-                st.markdown(f"**{item['subject']}**")
-            with col2:
-                st.markdown(f"{item['content']}")
-            with col3:
-                st.markdown(f"{item['duration']}時間")
-            with col4:
-                if st.button("🗑️", key=f"remove_item_{i}"):
-                    st.session_state.plan_template_items.pop(i)
-                    st.rerun()
+        items_df = pd.DataFrame([
+            {
+                "選択": False,
+                "科目": item['subject'],
+                "内容": item['content'],
+                "時間": item['duration']
+            }
+            for item in st.session_state.plan_template_items
+        ])
+        
+        edited_items_df = st.data_editor(
+            items_df,
+            use_container_width=True,
+            num_rows="fixed",
+            column_config={
+                "選択": st.column_config.CheckboxColumn("選択", help="削除する項目を選択"),
+                "科目": st.column_config.TextColumn("科目", disabled=True),
+                "内容": st.column_config.TextColumn("内容", disabled=True, width="large"),
+                "時間": st.column_config.NumberColumn("時間", disabled=True)
+            },
+            hide_index=True,
+            key="plan_template_items_editor"
+        )
+        
+        if st.button("🗑️ 選択した項目を削除", key="remove_plan_items_btn"):
+            selected_indices = edited_items_df.index[edited_items_df["選択"]].tolist()
+            if selected_indices:
+                for index in sorted(selected_indices, reverse=True):
+                    st.session_state.plan_template_items.pop(index)
+                st.rerun()
+            else:
+                st.warning("削除する項目を選択してください")
     else:
         st.info("💡 学習項目を追加してください。")
     
@@ -413,7 +578,7 @@ def create_plan_template():
             return
         
         template = {
-            "id": datetime.now().strftime("%Y%m%d_%H%M%S"),
+            "id": str(uuid.uuid4()),
             "name": template_name,
             "description": template_description,
             "plan_type": plan_type,
@@ -421,9 +586,7 @@ def create_plan_template():
             "items": st.session_state.plan_template_items.copy()
         }
         
-        templates = load_plan_templates()
-        templates.append(template)
-        save_plan_templates(templates)
+        save_plan_template(template)
         
         st.success(f"✅ 計画テンプレート「{template_name}」を保存しました!")
         log_info(f"学習計画テンプレート作成: {template_name} ({len(st.session_state.plan_template_items)}項目)", "TEMPLATES")
@@ -436,21 +599,21 @@ def use_plan_template():
     """テンプレートから学習計画を作成"""
     st.markdown("### ✨ テンプレートから計画を作成")
     
-    templates = load_plan_templates()
+    templates, templates_by_name = load_plan_templates_indexed()
     
     if not templates:
         st.info("💡 計画テンプレートが登録されていません。「テンプレート作成」タブから作成してください。")
         return
     
     # テンプレート選択
-    template_names = [t['name'] for t in templates]
+    template_names = list(templates_by_name)
     selected_template_name = st.selectbox("使用するテンプレート", options=template_names)
     
     if not selected_template_name:
         return
     
     # 選択されたテンプレートを取得
-    selected_template = next((t for t in templates if t['name'] == selected_template_name), None)
+    selected_template = templates_by_name.get(selected_template_name)
     
     if not selected_template:
         st.error("❌ テンプレートの読み込みに失敗しました。")
@@ -467,8 +630,7 @@ def use_plan_template():
     
     # 学習項目プレビュー
     st.markdown("#### 📚 学習項目")
-    for item in selected_template['items']:
-        st.markdown(f"- **{item['subject']}**: {item['content']} ({item['duration']}時間)")
+    st.table(plan_items_dataframe(selected_template['items']))
     
     total_hours = sum([item['duration'] for item in selected_template['items']])
     st.info(f"💡 合計学習時間: {total_hours}時間")
@@ -495,7 +657,7 @@ def manage_plan_templates():
         return
     
     # テンプレート一覧表示
-    for i, template in enumerate(templates):
+    for template in templates:
         with st.expander(f"📋 {template['name']} ({len(template['items'])}項目)"):
             st.markdown(f"**ID**: {template['id']}")
             st.markdown(f"**計画タイプ**: {template['plan_type']}")
@@ -504,16 +666,13 @@ def manage_plan_templates():
                 st.markdown(f"**説明**: {template['description']}")
             
             st.markdown("**学習項目**:")
-            total_hours = 0
-            for item in template['items']:
-                st.markdown(f"- {item['subject']}: {item['content']} ({item['duration']}時間)")
-                total_hours += item['duration']
+            st.table(plan_items_dataframe(template['items']))
+            total_hours = sum(item['duration'] for item in template['items'])
             
             st.markdown(f"**合計学習時間**: {total_hours}時間")
             
             # 削除ボタン
-            if st.button(f"🗑️ このテンプレートを削除", key=f"delete_plan_template_{i}"):
-                templates.pop(i)
-                save_plan_templates(templates)
+            if st.button(f"🗑️ このテンプレートを削除", key=f"delete_plan_template_{template['id']}"):
+                delete_plan_template(template['id'])
                 st.success(f"✅ テンプレート「{template['name']}」を削除しました。")
                 st.rerun()
@@ -4,11 +4,59 @@ render_mini_voice_agent() の機能を分割して保守性を向上
 """
 
 import os
+import hashlib
 import json
-import tempfile
+import re
+import threading
+import time
 import uuid
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter, Retry
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from logger import log_error
+
+try:
+    import orjson  # 任意: インストールされていればJSONの読み書きを高速化
+except ImportError:
+    orjson = None
+
+
+# デバッグ表示の有無（起動時に一度だけ環境変数を確認）
+_DEBUG = bool(os.environ.get("SAPI_DEBUG"))
+
+# 応答の最大トークン数（GPT-5推論モデルは推論トークンもここに含まれる）
+MAX_COMPLETION_TOKENS = 2000
+
+# LLM に送る会話履歴の最大ターン数（1ターン = ユーザー発言 + 応答。system プロンプトを除く）
+HISTORY_WINDOW_TURNS = 6
+HISTORY_WINDOW_MESSAGES = HISTORY_WINDOW_TURNS * 2
+
+# セッションに保持する会話履歴の最大件数と、超えたときに残す件数（system プロンプトを除く）
+# （上限に達するたびに半分まで減らし、毎回の追加でリスト先頭を削除しないようにする）
+HISTORY_MAX_STORED_MESSAGES = 40
+HISTORY_TRIM_TO_MESSAGES = 20
+
+# 画面に表示するチャット履歴の件数
+CHAT_HISTORY_DISPLAY_MESSAGES = 6
+
+# TTS のネットワーク待ちを UI スレッドから切り離すためのワーカー
+# （ワーカーはプロセス内で使い回し、各ワーカーは自分用の HTTP セッションを保持する）
+_TTS_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="voice_tts")
+_tts_thread_local = threading.local()
+
+# 同一リクエストの応答・音声を使い回すためのプロセス内キャッシュ（古いものから破棄）
+# このアプリは1人の利用者がローカルのJSONデータを参照する前提で、どのセッションも同じデータを読む。
+# 応答キャッシュのキーは送信メッセージ全体（履歴・RAG コンテキストを含む）なので、ヒットするのは
+# 全く同じプロンプトを送ったとき（ページを開き直して同じ質問をした場合など）に限られ、
+# そのためにセッション間で共有している。古い応答を返し続けないよう有効期限を設ける。
+RESPONSE_CACHE_MAX_ENTRIES = 64
+RESPONSE_CACHE_TTL_SECONDS = 3600
+SPEECH_CACHE_MAX_ENTRIES = 16
+_response_cache = OrderedDict()
+_speech_cache = OrderedDict()
+_cache_lock = threading.Lock()
 
 
 def initialize_voice_agent():
@@ -23,8 +71,8 @@ def initialize_voice_agent():
     if "recorder_session_id" not in st.session_state:
         st.session_state["recorder_session_id"] = str(uuid.uuid4())
     
-    if "last_audio_data" not in st.session_state:
-        st.session_state["last_audio_data"] = None
+    if "last_audio_digest" not in st.session_state:
+        st.session_state["last_audio_digest"] = None
         
     if "recorder_reset_needed" not in st.session_state:
         st.session_state["recorder_reset_needed"] = False
@@ -32,162 +80,411 @@ def initialize_voice_agent():
     # 安定した文字起こし保存用キー
     if "last_transcription" not in st.session_state:
         st.session_state["last_transcription"] = ""
+    
+    # 応答の自動読み上げ（既定はオフ。履歴の「読み上げ」ボタンで個別に再生できる）
+    if "voice_auto_speak" not in st.session_state:
+        st.session_state["voice_auto_speak"] = False
+
+
+def append_chat_message(role: str, content: str):
+    """会話履歴にメッセージを追加し、保持件数の上限を超えた古いメッセージを捨てる"""
+    msgs = st.session_state["voice_agent_messages"]
+    msgs.append({"role": role, "content": content})
+    
+    # 先頭の system プロンプトは常に残す
+    keep_head = 1 if msgs[0].get("role") == "system" else 0
+    if len(msgs) - keep_head > HISTORY_MAX_STORED_MESSAGES:
+        cut = len(msgs) - HISTORY_TRIM_TO_MESSAGES
+        # 残す履歴が応答から始まらないよう、対応する質問ごと落とす
+        if msgs[cut].get("role") == "assistant":
+            cut += 1
+        del msgs[keep_head:cut]
+
+
+@st.cache_resource(show_spinner=False)
+def _create_azure_clients(gpt_api_key: str, gpt_endpoint: str, gpt_api_version: str,
+                          voice_api_key: str, voice_endpoint: str, voice_api_version: str):
+    """
+    GPT用・音声認識用の AzureOpenAI クライアントを作成（設定ごとにプロセス内で1回だけ）
+    
+    クライアントを再利用することで、再実行のたびに接続プールを作り直さず
+    HTTP keep-alive の接続を使い回せる。
+    """
+    from openai import AzureOpenAI
+    
+    # GPT用クライアント（East US 2）
+    gpt_client = AzureOpenAI(
+        api_key=gpt_api_key,
+        azure_endpoint=gpt_endpoint,
+        api_version=gpt_api_version,
+    )
+    
+    # 音声認識用クライアント（gpt-4o-mini-transcribe）
+    voice_client = AzureOpenAI(
+        api_key=voice_api_key,
+        azure_endpoint=voice_endpoint,
+        api_version=voice_api_version,
+    )
+    return gpt_client, voice_client
+
+
+# クライアントを取得できなかった場合の戻り値（成功時と同じ5要素）
+_NO_AZURE_CLIENT = (None, None, None, None, None)
+
+
+def _azure_env() -> dict:
+    """Azure OpenAI 関連の環境変数をまとめて読み込む（エンドポイント末尾のスラッシュは除去）"""
+    # GPT用クライアント（メインのAzure OpenAI - East US 2）
+    gpt_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    # 音声認識用クライアント（gpt-4o-mini-transcribe用）
+    voice_api_key = os.getenv("AZURE_OPENAI_KEY")
+    voice_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    # TTS用の設定（REST API用、未設定の場合は音声認識用の値を使用）
+    tts_endpoint = os.getenv("VOICE_TTS_ENDPOINT", voice_endpoint)
+    
+    # ⚠️ 末尾スラッシュを削除（Azure OpenAI SDKでは不要）
+    return {
+        "gpt_api_key": os.getenv("AZURE_OPENAI_KEY"),
+        "gpt_endpoint": gpt_endpoint.rstrip('/') if gpt_endpoint else gpt_endpoint,
+        "gpt_api_version": os.getenv("AZURE_OPENAI_API_VERSION", "2024-10-21"),
+        "voice_api_key": voice_api_key,
+        "voice_endpoint": voice_endpoint.rstrip('/') if voice_endpoint else voice_endpoint,
+        "voice_api_version": os.getenv("VOICE_AZURE_OPENAI_API_VERSION", "2024-06-01"),
+        "tts_api_key": os.getenv("VOICE_TTS_API_KEY", voice_api_key),
+        "tts_endpoint": tts_endpoint.rstrip('/') if tts_endpoint else None,
+        "tts_api_version": os.getenv("VOICE_TTS_API_VERSION", "2025-03-01-preview"),
+        # デプロイメント名（.envから取得）
+        "gpt_deployment_name": os.getenv("AZURE_OPENAI_MODEL", "gpt-5-mini"),
+        "stt_deployment_name": os.getenv("VOICE_STT_DEPLOYMENT_NAME", "gpt-4o-mini-transcribe"),
+        "tts_deployment_name": os.getenv("VOICE_TTS_DEPLOYMENT_NAME", "gpt-4o-mini-tts"),
+    }
 
 
 def get_azure_client():
-    """Azure OpenAI クライアントの取得（音声認識・TTS対応）"""
+    """
+    Azure OpenAI クライアントの取得（音声認識・TTS対応）
+    
+    Returns:
+        (GPTクライアント, 音声認識クライアント, GPTデプロイメント名, STTデプロイメント名, TTS設定)。
+        取得できない場合はすべて None
+    """
     try:
-        from openai import AzureOpenAI
+        from openai import AzureOpenAI  # noqa: F401 (インストール確認用)
     except Exception:
         st.warning("openai パッケージが未インストールです。'pip install openai' を実行してください。")
-        return None, None, None, None, None, None, None
-    
-    # GPT用クライアント（メインのAzure OpenAI - East US 2）
-    GPT_API_KEY = os.getenv("AZURE_OPENAI_KEY")
-    GPT_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-    GPT_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-10-21")
+        return _NO_AZURE_CLIENT
     
-    # 音声認識用クライアント（gpt-4o-mini-transcribe用）
-    VOICE_API_KEY = os.getenv("AZURE_OPENAI_KEY")
-    VOICE_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-    VOICE_API_VERSION = os.getenv("VOICE_AZURE_OPENAI_API_VERSION", "2024-06-01")
-    
-    # TTS用の設定（REST API用）
-    TTS_API_KEY = os.getenv("VOICE_TTS_API_KEY", VOICE_API_KEY)  # 未設定の場合はVOICE_API_KEYを使用
-    TTS_ENDPOINT = os.getenv("VOICE_TTS_ENDPOINT", VOICE_ENDPOINT)  # 未設定の場合はVOICE_ENDPOINTを使用
-    TTS_API_VERSION = os.getenv("VOICE_TTS_API_VERSION", "2025-03-01-preview")
+    env = _azure_env()
     
-    # デバッグ情報（本番環境では削除推奨）
-    if not GPT_API_KEY or not GPT_ENDPOINT:
+    if not env["gpt_api_key"] or not env["gpt_endpoint"]:
         st.error("❌ GPT用の環境変数が設定されていません！")
-        st.info(f"GPT API Key: {'設定済み' if GPT_API_KEY else '未設定'}")
-        st.info(f"GPT Endpoint: {GPT_ENDPOINT if GPT_ENDPOINT else '未設定'}")
-        return None, None, None, None, None, None, None
+        st.info(f"GPT API Key: {'設定済み' if env['gpt_api_key'] else '未設定'}")
+        st.info(f"GPT Endpoint: {env['gpt_endpoint'] if env['gpt_endpoint'] else '未設定'}")
+        return _NO_AZURE_CLIENT
     
-    if not VOICE_API_KEY or not VOICE_ENDPOINT:
+    if not env["voice_api_key"] or not env["voice_endpoint"]:
         st.error("❌ 音声認識用の環境変数が設定されていません！")
-        st.info(f"Voice API Key: {'設定済み' if VOICE_API_KEY else '未設定'}")
-        st.info(f"Voice Endpoint: {VOICE_ENDPOINT if VOICE_ENDPOINT else '未設定'}")
-        return None, None, None, None, None, None, None
-    
-    # ⚠️ 末尾スラッシュを削除（Azure OpenAI SDKでは不要）
-    GPT_ENDPOINT = GPT_ENDPOINT.rstrip('/')
-    VOICE_ENDPOINT = VOICE_ENDPOINT.rstrip('/')
-    TTS_ENDPOINT = TTS_ENDPOINT.rstrip('/') if TTS_ENDPOINT else None
+        st.info(f"Voice API Key: {'設定済み' if env['voice_api_key'] else '未設定'}")
+        st.info(f"Voice Endpoint: {env['voice_endpoint'] if env['voice_endpoint'] else '未設定'}")
+        return _NO_AZURE_CLIENT
     
     try:
-        # GPT用クライアント（East US 2）
-        gpt_client = AzureOpenAI(
-            api_key=GPT_API_KEY,
-            azure_endpoint=GPT_ENDPOINT,
-            api_version=GPT_API_VERSION,
-        )
-        
-        # 音声認識用クライアント（gpt-4o-mini-transcribe）
-        voice_client = AzureOpenAI(
-            api_key=VOICE_API_KEY,
-            azure_endpoint=VOICE_ENDPOINT,
-            api_version=VOICE_API_VERSION,
+        # クライアントは設定ごとにプロセス内で使い回される（st.cache_resource）
+        gpt_client, voice_client = _create_azure_clients(
+            env["gpt_api_key"], env["gpt_endpoint"], env["gpt_api_version"],
+            env["voice_api_key"], env["voice_endpoint"], env["voice_api_version"],
         )
     except Exception as e:
         st.error(f"❌ Azure OpenAI クライアント初期化エラー: {e}")
-        return None, None, None, None, None, None, None
-    
-    # デプロイメント名（.envから取得）
-    GPT_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_MODEL", "gpt-5-mini")
-    STT_DEPLOYMENT_NAME = os.getenv("VOICE_STT_DEPLOYMENT_NAME", "gpt-4o-mini-transcribe")
-    TTS_DEPLOYMENT_NAME = os.getenv("VOICE_TTS_DEPLOYMENT_NAME", "gpt-4o-mini-tts")
+        return _NO_AZURE_CLIENT
     
     # TTS設定を辞書にまとめる
     tts_config = {
-        "api_key": TTS_API_KEY,
-        "endpoint": TTS_ENDPOINT,
-        "api_version": TTS_API_VERSION,
-        "deployment_name": TTS_DEPLOYMENT_NAME
+        "api_key": env["tts_api_key"],
+        "endpoint": env["tts_endpoint"],
+        "api_version": env["tts_api_version"],
+        "deployment_name": env["tts_deployment_name"]
     }
     
-    return gpt_client, voice_client, GPT_DEPLOYMENT_NAME, STT_DEPLOYMENT_NAME, tts_config
+    return gpt_client, voice_client, env["gpt_deployment_name"], env["stt_deployment_name"], tts_config
+
+
+def _cache_get(cache: OrderedDict, key):
+    """キャッシュから取得（期限切れは破棄し、ヒットしたものを最新として扱う）"""
+    with _cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache: OrderedDict, key, value, max_entries: int, ttl: float = None):
+    """キャッシュへ保存し、上限を超えた分を古い順に破棄（ttl 秒を過ぎたものは取得時に破棄）"""
+    expires_at = time.monotonic() + ttl if ttl is not None else None
+    with _cache_lock:
+        cache[key] = (expires_at, value)
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+
+def _response_cache_key(messages: list, model: str) -> str:
+    """送信メッセージ全体（RAG コンテキストを含む）とモデル名から応答キャッシュのキーを作る"""
+    payload = json.dumps([model, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
 
 
 def load_json_safe(path: str):
     """JSONファイルの安全な読み込み"""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            raw = f.read()
+        if orjson:
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                # json.dump が書き出す NaN / Infinity は orjson では読めないため標準の json で読み直す
+                pass
+        return json.loads(raw)
     except Exception:
         return None
 
 
-def contains_any(text: str, keywords: list[str]) -> bool:
-    """テキストに指定されたキーワードが含まれているかチェック"""
-    text = text or ""
-    return any((k in text) for k in keywords if k)
+# RAG で参照するローカルJSON (ファイル名から拡張子を除いた名前とパス。パスは読み込み時に一度だけ組み立てる)
+_RAG_SOURCE_NAMES = ("subjects", "grades", "progress", "reminders")
+_RAG_BASE_DIR = os.path.dirname(__file__)
+_RAG_SOURCE_PATHS = tuple(os.path.join(_RAG_BASE_DIR, f"{name}.json") for name in _RAG_SOURCE_NAMES)
+
+
+def _file_mtime(path: str):
+    """ファイルの更新時刻 (存在しない場合は None)"""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _load_json_cached(path: str, mtime) -> object:
+    """
+    JSONファイルを読み込む（ファイル単位のキャッシュ付き）
+    
+    mtime はキャッシュキー専用の引数で、ファイルが更新されるとキーが変わって
+    そのファイルだけが再読み込みされる。
+    """
+    return load_json_safe(path)
+
+
+def _load_rag_sources(mtimes: tuple) -> dict:
+    """RAG用のJSONをまとめて読み込む（更新されたファイルのみ再パースされる）"""
+    return {
+        name: _load_json_cached(path, mtime)
+        for name, path, mtime in zip(_RAG_SOURCE_NAMES, _RAG_SOURCE_PATHS, mtimes)
+    }
+
+
+# 進捗・リマインダーをコンテキストに含めるかを判定するキーワード
+_PROGRESS_KEYWORDS = ("進捗", "時間", "学習", "モチベーション", "progress", "study")
+_REMINDER_KEYWORDS = ("予定", "リマインダー", "締切", "試験", "reminder", "deadline", "exam")
+
+# キーワードごとの部分文字列検索を繰り返すより速いので、起動時に一度だけ正規表現へまとめておく
+_PROGRESS_RE = re.compile("|".join(map(re.escape, _PROGRESS_KEYWORDS)))
+_REMINDER_RE = re.compile("|".join(map(re.escape, _REMINDER_KEYWORDS)))
+
+# RAG を構築する質問の最小文字数（空や1文字の入力だけを除く。日本語では
+# 「数学は」「成績？」のような3文字でもデータを求める質問になるため、それ以上は絞らない）
+_RAG_MIN_QUERY_CHARS = 2
+
+# RAGコンテキストの最大文字数（超えた分は先頭を優先してカット）
+_RAG_MAX_CONTEXT_CHARS = 8000
+
+# 科目一覧をマッピング用に付与する質問の最大文字数
+_SUBJECTS_HINT_MAX_QUERY_CHARS = 20
+
+
+def _dumps_compact(obj) -> str:
+    """LLM に渡すための空白なしJSON（インデントはトークンを増やすだけなので付けない）"""
+    if orjson:
+        # 標準の json と同様に数値などのキーも受け付ける（既定の orjson は str キー以外で例外になる）
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _pick_recent(data: dict, subjects_in_query: list) -> dict:
+    """
+    科目ごとの最新レコードを抽出
+    
+    質問に科目名があればその科目の最新5件、なければ全科目の最新3件。
+    """
+    if subjects_in_query:
+        return {s: data[s][-5:] for s in subjects_in_query if isinstance(data.get(s), list)}
+    return {s: arr[-3:] for s, arr in data.items() if isinstance(arr, list)}
 
 
 def build_rag_context(query: str) -> str:
     """RAGコンテキストの構築（関連するJSONデータを取得）"""
-    base = os.path.dirname(__file__)
-    subjects = load_json_safe(os.path.join(base, "subjects.json"))
-    grades = load_json_safe(os.path.join(base, "grades.json"))
-    progress = load_json_safe(os.path.join(base, "progress.json"))
-    reminders = load_json_safe(os.path.join(base, "reminders.json"))
-    
-    q = query or ""
-    subjects_in_query = []
+    q = (query or "").strip()
+    # 空や1文字だけの入力ではデータを参照しない（ファイル確認も省略）
+    if len(q) < _RAG_MIN_QUERY_CHARS:
+        return ""
+    mtimes = tuple(_file_mtime(path) for path in _RAG_SOURCE_PATHS)
+    
+    # 質問から読み取るのは「どの科目・どの種類のデータが必要か」だけ
+    # （科目もキーワードも数十件程度なので、単純な部分文字列検索が最も速い）
+    subjects = _load_json_cached(_RAG_SOURCE_PATHS[0], mtimes[0])
     if isinstance(subjects, list):
-        for s in subjects:
-            if isinstance(s, str) and s and s in q:
-                subjects_in_query.append(s)
+        subjects_in_query = tuple(s for s in subjects if isinstance(s, str) and s and s in q)
+    else:
+        subjects_in_query = ()
+    wants_progress = _PROGRESS_RE.search(q) is not None
+    wants_reminders = _REMINDER_RE.search(q) is not None
+    # 科目一覧は、質問に科目名がない短い質問のときだけマッピング用に付与
+    wants_subjects = not subjects_in_query and len(q) < _SUBJECTS_HINT_MAX_QUERY_CHARS
     
-    parts: list[str] = []
+    return _assemble_rag_context(subjects_in_query, mtimes, wants_progress, wants_reminders, wants_subjects)
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _assemble_rag_context(subjects_in_query: tuple, mtimes: tuple,
+                          wants_progress: bool, wants_reminders: bool, wants_subjects: bool) -> str:
+    """
+    build_rag_context の本体（キャッシュ付き）
     
-    # 常に科目一覧は付与（短いのでマッピングに役立つ）
-    if subjects is not None:
-        parts.append("[subjects]\n" + json.dumps(subjects, ensure_ascii=False, indent=2))
+    コンテキストの内容は質問文そのものではなく、該当科目・キーワードの有無・
+    データファイルの更新時刻だけで決まるため、それらをキーにする。言い回しが
+    違っても同じデータを求める質問では、JSONの再シリアライズを省略できる。
+    """
+    sources = _load_rag_sources(mtimes)
+    sections = _iter_rag_sections(sources["subjects"], sources["grades"], sources["progress"],
+                                  sources["reminders"], subjects_in_query,
+                                  wants_progress, wants_reminders, wants_subjects)
+    # 長すぎる場合は先頭を優先してカット
+    return _join_sections_within_limit(sections, _RAG_MAX_CONTEXT_CHARS)
+
+
+def _iter_rag_sections(subjects, grades, progress, reminders,
+                       subjects_in_query, wants_progress, wants_reminders, wants_subjects):
+    """
+    RAGコンテキストの各セクションを先頭から順に生成
     
+    ジェネレータなので、上限に達した後のセクションはシリアライズされない。
+    参照できるデータが1件もない場合は何も生成しない（科目一覧だけを送ることはしない）。
+    """
     # 成績
-    if isinstance(grades, dict):
-        pick = {}
-        if subjects_in_query:
-            for s in subjects_in_query:
-                if s in grades and isinstance(grades[s], list):
-                    pick[s] = grades[s][-5:]
-        else:
-            # 各科目の最新3件
-            for s, arr in grades.items():
-                if isinstance(arr, list):
-                    pick[s] = arr[-3:]
-        if pick:
-            parts.append("[grades] (最新)\n" + json.dumps(pick, ensure_ascii=False, indent=2))
-    
-    # 進捗
-    if isinstance(progress, dict):
-        pick = {}
-        if subjects_in_query:
-            for s in subjects_in_query:
-                if s in progress and isinstance(progress[s], list):
-                    pick[s] = progress[s][-5:]
-        else:
-            for s, arr in progress.items():
-                if isinstance(arr, list):
-                    pick[s] = arr[-3:]
-        if pick and contains_any(q, ["進捗", "時間", "学習", "モチベーション", "progress", "study"]):
-            parts.append("[progress] (最新)\n" + json.dumps(pick, ensure_ascii=False, indent=2))
+    grades_pick = _pick_recent(grades, subjects_in_query) if isinstance(grades, dict) else {}
+    
+    # 進捗（キーワードがない場合は抽出自体を行わない）
+    progress_pick = {}
+    if wants_progress and isinstance(progress, dict):
+        progress_pick = _pick_recent(progress, subjects_in_query)
     
     # リマインダー
-    if isinstance(reminders, list):
-        pick = reminders
+    reminders_pick = []
+    if wants_reminders and isinstance(reminders, list):
+        reminders_pick = reminders
         if subjects_in_query:
-            pick = [r for r in reminders if isinstance(r, dict) and r.get("subject") in subjects_in_query]
-        if pick and contains_any(q, ["予定", "リマインダー", "締切", "試験", "reminder", "deadline", "exam"]):
-            parts.append("[reminders]\n" + json.dumps(pick, ensure_ascii=False, indent=2))
+            reminders_pick = [r for r in reminders if isinstance(r, dict) and r.get("subject") in subjects_in_query]
     
-    # 長すぎる場合は先頭を優先してカット
-    ctx = "\n\n".join(parts)
-    max_chars = 8000
-    if len(ctx) > max_chars:
-        ctx = ctx[:max_chars] + "\n... (truncated)"
-    return ctx
+    if not (grades_pick or progress_pick or reminders_pick):
+        return
+    
+    # 科目一覧（マッピング用）。抽出したデータのキーで全科目が分かる場合は省く
+    if wants_subjects and isinstance(subjects, list):
+        if any(s not in grades_pick and s not in progress_pick for s in subjects if isinstance(s, str)):
+            yield "[subjects]\n" + _dumps_compact(subjects)
+    
+    if grades_pick:
+        yield "[grades] (最新)\n" + _dumps_compact(grades_pick)
+    if progress_pick:
+        yield "[progress] (最新)\n" + _dumps_compact(progress_pick)
+    if reminders_pick:
+        yield "[reminders]\n" + _dumps_compact(reminders_pick)
+
+
+def _join_sections_within_limit(sections, max_chars: int) -> str:
+    """
+    セクションを空行区切りで連結し、max_chars を超える分は切り捨てる
+    
+    上限に達した時点で以降のセクションを取り出さずに打ち切り、最後に一度だけ連結する。
+    """
+    fragments: list[str] = []
+    total = 0
+    for section in sections:
+        block = "\n\n" + section if fragments else section
+        if total + len(block) > max_chars:
+            fragments.append(block[:max_chars - total])
+            fragments.append("\n... (truncated)")
+            break
+        fragments.append(block)
+        total += len(block)
+    return "".join(fragments)
+
+
+def _audio_digest(audio_bytes):
+    """録音データの重複判定用ダイジェスト（バイト列そのものを保持しないため）"""
+    return hashlib.blake2b(audio_bytes, digest_size=16).hexdigest()
+
+
+# STT に渡せる音声形式（拡張子 → MIME タイプ）
+_AUDIO_MIME_TYPES = {
+    ".wav": "audio/wav",
+    ".webm": "audio/webm",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+}
+
+
+def _sniff_audio_suffix(audio_bytes: bytes) -> str:
+    """先頭のマジックバイトから音声のコンテナ形式を判定（不明な場合は WAV とみなす）"""
+    if audio_bytes[:4] == b"RIFF":
+        return ".wav"
+    if audio_bytes[:4] == b"\x1aE\xdf\xa3":
+        return ".webm"
+    if audio_bytes[:3] == b"ID3" or audio_bytes[:2] == b"\xff\xfb":
+        return ".mp3"
+    if audio_bytes[4:8] == b"ftyp":
+        return ".m4a"
+    # audio-recorder-streamlitはWAV形式で録音するため、WAVを既定とする
+    return ".wav"
+
+
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def _transcribe_audio(_client, STT_DEPLOYMENT_NAME, digest, _audio_bytes):
+    """音声を文字起こしする（同じ録音の再送信時は API を呼ばずキャッシュを返す）
+
+    キャッシュキーは digest とデプロイメント名のみ。クライアントと音声本体は
+    ハッシュ対象から外している。失敗時は例外を送出する（例外はキャッシュされない）。
+    """
+    from openai import BadRequestError
+    
+    # 判定した形式で一度だけ送信し、形式が受け付けられなかった場合のみ残りの形式を順に試す
+    sniffed = _sniff_audio_suffix(_audio_bytes)
+    suffixes = [sniffed] + [suffix for suffix in _AUDIO_MIME_TYPES if suffix != sniffed]
+    
+    first_error = None
+    for suffix in suffixes:
+        try:
+            # 録音データはメモリ上にあるので、一時ファイルを経由せずそのまま渡す
+            transcription = _client.audio.transcriptions.create(
+                model=STT_DEPLOYMENT_NAME,
+                file=(f"audio{suffix}", _audio_bytes, _AUDIO_MIME_TYPES[suffix]),
+                # 結果はプレーンテキストだけを受け取り、サンプリングのぶれを抑える
+                response_format="text",
+                temperature=0,
+            )
+            return transcription if isinstance(transcription, str) else str(transcription)
+        except BadRequestError as e:
+            # 認証・通信・レート制限などのエラーは形式を変えても同じなので、そのまま送出する
+            if first_error is None:
+                first_error = e
+    
+    # すべての形式で失敗した場合は、判定した形式でのエラーを報告する
+    raise first_error
 
 
 def handle_voice_input(client, STT_DEPLOYMENT_NAME):
@@ -215,60 +512,18 @@ def handle_voice_input(client, STT_DEPLOYMENT_NAME):
     # 音声認識処理（改良版 - 複数形式対応）
     transcribed_text = ""
     
-    if audio_bytes and audio_bytes != st.session_state["last_audio_data"]:
-        st.session_state["last_audio_data"] = audio_bytes
+    digest = _audio_digest(audio_bytes) if audio_bytes else None
+    if digest and digest != st.session_state["last_audio_digest"]:
+        st.session_state["last_audio_digest"] = digest
         
         with st.spinner("音声認識中…"):
-            tmp_path = None
             try:
-                # audio-recorder-streamlitはWAV形式で録音するため、WAVを最優先
-                formats_to_try = [
-                    (".wav", "audio/wav"),
-                    (".webm", "audio/webm"),
-                    (".mp3", "audio/mpeg"),
-                    (".m4a", "audio/mp4"),
-                ]
-                
-                last_error = None
-                for suffix, mime_type in formats_to_try:
-                    try:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                            tmp.write(audio_bytes)
-                            tmp_path = tmp.name
-                        
-                        with open(tmp_path, "rb") as f:
-                            transcription = client.audio.transcriptions.create(
-                                model=STT_DEPLOYMENT_NAME,
-                                file=(f"audio{suffix}", f, mime_type),
-                                response_format="text",
-                            )
-                        
-                        # 成功したらループを抜ける
-                        transcribed_text = transcription if isinstance(transcription, str) else str(transcription)
-                        st.success("✅ 音声認識完了！内容を確認して送信してください。")
-                        break
-                        
-                    except Exception as e:
-                        last_error = e
-                        # 最初の形式（WAV）で失敗した場合のみ警告を表示
-                        if suffix == ".wav":
-                            st.info("🔄 別の形式で試行中...")
-                        if tmp_path and os.path.exists(tmp_path):
-                            try:
-                                os.remove(tmp_path)
-                            except Exception:
-                                pass
-                        tmp_path = None
-                        continue
-                
-                # すべての形式で失敗した場合
-                if not transcribed_text and last_error:
-                    raise last_error
+                transcribed_text = _transcribe_audio(client, STT_DEPLOYMENT_NAME, digest, audio_bytes)
+                st.success("✅ 音声認識完了！内容を確認して送信してください。")
                 
                 # 録音完了後に自動リセット（新しい録音のために）
                 if transcribed_text:
                     st.session_state["recorder_session_id"] = str(uuid.uuid4())
-                    st.session_state["last_audio_data"] = None
                     st.session_state["last_transcription"] = transcribed_text
                 
             except Exception as e:
@@ -280,45 +535,62 @@ def handle_voice_input(client, STT_DEPLOYMENT_NAME):
                 st.write(f"4. デプロイメント名: `{STT_DEPLOYMENT_NAME}`")
                 st.write("5. Azure Portalでデプロイメント名とAPIキーを確認してください")
                 
-                # デバッグ用: 音声データの先頭バイトを表示
-                if audio_bytes and len(audio_bytes) > 0:
-                    st.write(f"🔍 音声データの先頭: {audio_bytes[:20].hex()}")
-                    
-            finally:
-                if tmp_path and os.path.exists(tmp_path):
-                    try:
-                        os.remove(tmp_path)
-                    except Exception:
-                        pass
+                # デバッグ用: 判定した音声形式とサイズを表示
+                if _DEBUG and audio_bytes:
+                    st.write(f"🔍 音声データ: 形式={_sniff_audio_suffix(audio_bytes)} サイズ={len(audio_bytes)} bytes")
+        
+        # 認識結果を確認している間に RAG コンテキストを作ってキャッシュしておき、
+        # 送信時は応答生成の API 呼び出しだけを待てばよいようにする
+        # （失敗しても送信時に作り直されるので、音声認識のエラーとしては扱わない）
+        if transcribed_text:
+            try:
+                build_rag_context(transcribed_text)
+            except Exception as e:
+                log_error(e, "RAGコンテキスト事前構築エラー", show_user=False)
     
     return transcribed_text
 
 
-def generate_speech(text: str, tts_config: dict, voice: str = "alloy") -> bytes:
+def _get_tts_session() -> requests.Session:
     """
-    テキストから音声を生成（REST API使用）
+    呼び出し元スレッド専用の HTTP セッションを取得
     
-    Args:
-        text: 音声化するテキスト
-        tts_config: TTS設定の辞書（api_key, endpoint, api_version, deployment_name）
-        voice: 使用する音声（alloy, echo, fable, onyx, nova, shimmer）
+    TTS ワーカーのスレッドごとにセッションを保持し、ターンをまたいで
+    keep-alive の接続（TLS ハンドシェイク済み）を再利用する。
+    """
+    session = getattr(_tts_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        # 一時的な混雑・障害（429/5xx）と接続失敗は短い間隔で自動再試行する（TTS の POST は再送しても安全）
+        # 読み取りタイムアウトは再試行しない（1回の呼び出しがタイムアウトの数倍待たされるのを防ぐ）
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=2,
+                read=0,
+                backoff_factor=0.2,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({"POST"}),
+                raise_on_status=False,
+            ),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _tts_thread_local.session = session
+    return session
+
+
+def _synthesize_speech(text: str, tts_config: dict, voice: str = "alloy") -> tuple:
+    """
+    TTS REST API を呼び出す（Streamlit を触らないのでワーカースレッドから実行できる）
     
     Returns:
-        bytes: 生成された音声データ（MP3形式）、エラー時はNone
+        (音声データ, エラーメッセージのリスト) の組。失敗時の音声データは None
     """
-    if not text or not text.strip():
-        return None
-    
-    # TTS設定の取得
     api_key = tts_config.get("api_key")
     endpoint = tts_config.get("endpoint")
     api_version = tts_config.get("api_version")
     deployment_name = tts_config.get("deployment_name")
     
-    if not all([api_key, endpoint, deployment_name]):
-        st.warning("⚠️ TTS設定が不完全です。.envファイルを確認してください。")
-        return None
-    
     # REST APIエンドポイントURL
     url = f"{endpoint}/openai/deployments/{deployment_name}/audio/speech?api-version={api_version}"
     
@@ -337,24 +609,152 @@ def generate_speech(text: str, tts_config: dict, voice: str = "alloy") -> bytes:
     
     try:
         # REST APIリクエスト
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = _get_tts_session().post(url, headers=headers, json=payload, timeout=30)
         
         if response.status_code == 200:
-            return response.content
+            return response.content, []
         else:
-            st.error(f"❌ TTS APIエラー: {response.status_code}")
-            st.error(f"詳細: {response.text}")
-            return None
+            return None, [f"❌ TTS APIエラー: {response.status_code}", f"詳細: {response.text}"]
             
     except requests.exceptions.Timeout:
-        st.error("❌ TTS API タイムアウト: 30秒以内に応答がありませんでした")
-        return None
+        return None, ["❌ TTS API タイムアウト: 30秒以内に応答がありませんでした"]
     except requests.exceptions.RequestException as e:
-        st.error(f"❌ TTS API リクエストエラー: {e}")
-        return None
+        return None, [f"❌ TTS API リクエストエラー: {e}"]
     except Exception as e:
-        st.error(f"❌ TTS 予期しないエラー: {e}")
+        return None, [f"❌ TTS 予期しないエラー: {e}"]
+
+
+def _synthesize_speech_cached(text: str, tts_config: dict, voice: str = "alloy") -> tuple:
+    """_synthesize_speech() の結果を (テキスト, 音声, デプロイメント名) 単位で使い回す"""
+    key = (text, voice, tts_config.get("deployment_name"))
+    audio_data = _cache_get(_speech_cache, key)
+    if audio_data is not None:
+        return audio_data, []
+    
+    audio_data, errors = _synthesize_speech(text, tts_config, voice)
+    if audio_data:
+        _cache_put(_speech_cache, key, audio_data, SPEECH_CACHE_MAX_ENTRIES)
+    return audio_data, errors
+
+
+def _tts_config_ready(tts_config: dict) -> bool:
+    """TTS設定が揃っているか確認（不足時は警告を表示）"""
+    if not all([tts_config.get("api_key"), tts_config.get("endpoint"), tts_config.get("deployment_name")]):
+        st.warning("⚠️ TTS設定が不完全です。.envファイルを確認してください。")
+        return False
+    return True
+
+
+def _last_speech(text: str) -> bytes:
+    """直前に再生した応答と同じ文章なら、その音声データを返す（なければ None）"""
+    if text and st.session_state.get("last_speech_text") == text:
+        return st.session_state.get("last_speech_audio")
+    return None
+
+
+def _remember_speech(text: str, audio_data: bytes):
+    """直前の応答の音声を保持する（「もう一度」などの再生で API を呼ばないため）"""
+    if text and audio_data:
+        st.session_state["last_speech_text"] = text
+        st.session_state["last_speech_audio"] = audio_data
+
+
+# 文単位で音声生成を始めるための区切り文字と、1回の TTS に渡す最小文字数
+# （短い文ごとに API を呼ぶと回数が増えるため、ある程度まとめてから送る）
+_SPEECH_SENTENCE_ENDS = frozenset("。！？!?\n")
+TTS_MIN_SEGMENT_CHARS = 40
+
+
+def _pop_speech_segments(buffer: str) -> tuple:
+    """
+    バッファから音声生成に回せる区切りを切り出す
+    
+    最小文字数に達した後の最初の文末で区切るため、テキストを一度に渡しても
+    ストリーミングで少しずつ渡しても同じ区切りになる（音声キャッシュが効く）。
+    
+    Returns:
+        (切り出した区切りのリスト, 残りのバッファ)
+    """
+    segments = []
+    start = 0
+    for i, ch in enumerate(buffer):
+        if ch in _SPEECH_SENTENCE_ENDS and i + 1 - start >= TTS_MIN_SEGMENT_CHARS:
+            segments.append(buffer[start:i + 1])
+            start = i + 1
+    return segments, buffer[start:]
+
+
+def _submit_speech_segment(segment: str, tts_config: dict, voice: str, speech_futures: list):
+    """区切りの音声生成をワーカーに投入する（空白だけの区切りは読み上げない）"""
+    if segment.strip():
+        speech_futures.append(_TTS_POOL.submit(_synthesize_speech_cached, segment, tts_config, voice))
+
+
+def start_speech_synthesis(text: str, tts_config: dict, voice: str = "alloy") -> list:
+    """
+    音声生成をバックグラウンドで開始する（文単位に分けてワーカーで並行生成）
+    
+    Returns:
+        list: 区切りごとの Future。結果は wait_for_speech() で受け取る。生成不要・不可の場合は空
+    """
+    if not text or not text.strip() or not _tts_config_ready(tts_config):
+        return []
+    
+    # 直前の応答と同じ文章なら、保持している音声をそのまま使う
+    last_audio = _last_speech(text)
+    if last_audio:
+        done = Future()
+        done.set_result((last_audio, []))
+        return [done]
+    
+    speech_futures = []
+    segments, rest = _pop_speech_segments(text)
+    for segment in segments + [rest]:
+        _submit_speech_segment(segment, tts_config, voice, speech_futures)
+    return speech_futures
+
+
+def _iter_with_speech(text_iter, tts_config: dict, speech_futures: list, voice: str = "alloy"):
+    """
+    ストリーミング中のテキストをそのまま流しつつ、文がまとまり次第音声生成を始める
+    
+    応答の生成と前半の文の音声生成が並行して進むため、応答完了後の待ち時間が短くなる。
+    """
+    buffer = ""
+    for piece in text_iter:
+        yield piece
+        buffer += piece
+        segments, buffer = _pop_speech_segments(buffer)
+        for segment in segments:
+            _submit_speech_segment(segment, tts_config, voice, speech_futures)
+    _submit_speech_segment(buffer, tts_config, voice, speech_futures)
+
+
+def wait_for_speech(speech_futures: list) -> bytes:
+    """
+    start_speech_synthesis() の完了を待ち、音声データを返す（エラーはここで表示）
+    
+    区切りごとの MP3 はフレーム単位でそのまま連結できるため、順番どおりに結合して返す。
+    """
+    if not speech_futures:
         return None
+    
+    with st.spinner("🔊 音声生成中..."):
+        results = [future.result() for future in speech_futures]
+    
+    chunks = []
+    errors = []
+    for audio_data, segment_errors in results:
+        if audio_data:
+            chunks.append(audio_data)
+        errors.extend(segment_errors)
+    # 同じ原因のエラーは区切りの数だけ繰り返さない
+    for message in dict.fromkeys(errors):
+        st.error(message)
+    if not chunks:
+        return None
+    st.success("✅ 音声生成完了！")
+    return b"".join(chunks)
 
 
 def render_input_ui():
@@ -407,80 +807,205 @@ def render_send_button():
         # 録音リセットボタン（デバッグ用）
         if st.button("🔄 録音リセット", help="録音ボタンが消えた時に使用"):
             st.session_state["recorder_session_id"] = str(uuid.uuid4())
-            st.session_state["last_audio_data"] = None
+            st.session_state["last_audio_digest"] = None
             st.session_state["recorder_reset_needed"] = False
             st.session_state["last_transcription"] = ""
-            st.rerun()
+            st.rerun(scope="fragment")
     
     return send
 
 
+def _iter_stream_text(stream):
+    """ストリーミング応答からテキスト差分だけを取り出す"""
+    for chunk in stream:
+        # Azure はコンテンツフィルタ結果のみの (choices が空の) チャンクを返すことがある
+        if chunk.choices:
+            delta = chunk.choices[0].delta
+            if delta and delta.content:
+                yield delta.content
+
+
 def generate_ai_response(client, GPT_DEPLOYMENT_NAME, final_input: str, tts_config: dict = None):
-    """AI応答の生成とTTS音声生成"""
+    """
+    AI応答の生成とTTS音声生成の開始
+    
+    Returns:
+        (応答テキスト, 音声生成の Future のリスト)。音声は wait_for_speech() で受け取る
+    """
     # RAG: 現在の質問に関連するJSONを注入
     rag_ctx = build_rag_context(final_input)
-    rag_system = {
-        "role": "system",
-        "content": (
-            "以下は参考用のローカルJSONデータです。これを最優先で参照し、"
-            "事実に基づき簡潔に日本語で回答してください。データに存在しないことは推測せず、"
-            "不明な点は『データからは不明』と述べてください。\n\n" + rag_ctx
-        ),
-    }
     
-    # 送信用メッセージ（先頭の system の直後に RAG を挿入）
+    # 送信用メッセージ（先頭の system の直後に RAG を挿入し、会話は直近分だけ送る）
     base_msgs = st.session_state["voice_agent_messages"]
-    if base_msgs and base_msgs[0].get("role") == "system":
-        messages_to_send = [base_msgs[0], rag_system] + base_msgs[1:]
-    else:
-        messages_to_send = [rag_system] + base_msgs
+    has_system = bool(base_msgs) and base_msgs[0].get("role") == "system"
+    # 直近分だけを一度のスライスで取り出す（履歴全体のコピーは作らない）
+    window_start = max(int(has_system), len(base_msgs) - HISTORY_WINDOW_MESSAGES)
+    # 窓の先頭が応答で始まる場合は、対応する質問が欠けているので落とす
+    if window_start < len(base_msgs) and base_msgs[window_start].get("role") == "assistant":
+        window_start += 1
+    messages_to_send = [base_msgs[0]] if has_system else []
+    # 参照データがない場合は RAG の system メッセージ自体を送らない
+    if rag_ctx:
+        messages_to_send.append({
+            "role": "system",
+            "content": (
+                "以下は参考用のローカルJSONデータです。これを最優先で参照し、"
+                "事実に基づき簡潔に日本語で回答してください。データに存在しないことは推測せず、"
+                "不明な点は『データからは不明』と述べてください。\n\n" + rag_ctx
+            ),
+        })
+    messages_to_send.extend(base_msgs[window_start:])
     
     ai_reply = None
-    audio_data = None
+    speech_futures = []
     
-    with st.spinner("🤖 応答生成中…"):
-        try:
-            # デバッグ情報を表示
-            st.info(f"🔍 使用モデル: {GPT_DEPLOYMENT_NAME}")
-            st.info(f"🔍 GPT API バージョン: {os.getenv('AZURE_OPENAI_API_VERSION', 'デフォルト')}")
-            st.info(f"🔍 GPT エンドポイント: {os.getenv('AZURE_OPENAI_ENDPOINT', '未設定')}")
+    # 同じ内容のリクエストには API を呼ばずに前回の応答を返す
+    cache_key = _response_cache_key(messages_to_send, GPT_DEPLOYMENT_NAME)
+    cached_reply = _cache_get(_response_cache, cache_key)
+    if cached_reply is not None:
+        st.markdown(cached_reply)
+        if tts_config:
+            speech_futures = start_speech_synthesis(cached_reply, tts_config)
+        return cached_reply, speech_futures
+    
+    try:
+        with st.spinner("🤖 応答生成中…"):
+            # デバッグ情報を表示（SAPI_DEBUG 設定時のみ）
+            if _DEBUG:
+                st.info(f"🔍 使用モデル: {GPT_DEPLOYMENT_NAME}")
+                st.info(f"🔍 GPT API バージョン: {os.getenv('AZURE_OPENAI_API_VERSION', 'デフォルト')}")
+                st.info(f"🔍 GPT エンドポイント: {os.getenv('AZURE_OPENAI_ENDPOINT', '未設定')}")
             
-            resp = client.chat.completions.create(
-                model=GPT_DEPLOYMENT_NAME,
-                messages=messages_to_send,
-                max_completion_tokens=1000,  # GPT-5推論モデル用
-                # temperature は推論モデルではサポートされていない（デフォルト値1を使用）
-            )
+            from openai import BadRequestError
+            
+            # temperature は推論モデルではサポートされていない（デフォルト値1を使用）
+            try:
+                stream = client.chat.completions.create(
+                    model=GPT_DEPLOYMENT_NAME,
+                    messages=messages_to_send,
+                    max_completion_tokens=MAX_COMPLETION_TOKENS,
+                    stream=True,
+                )
+            except BadRequestError:
+                # ストリーミング非対応のデプロイメントは 400 で拒否するので、通常の呼び出しに切り替える
+                # （認証・通信・レート制限などのエラーは再送せず、そのまま下の except で表示する）
+                stream = None
+                resp = client.chat.completions.create(
+                    model=GPT_DEPLOYMENT_NAME,
+                    messages=messages_to_send,
+                    max_completion_tokens=MAX_COMPLETION_TOKENS,
+                )
+        
+        # 生成されたトークンから順に表示し、文がまとまり次第音声生成も始める
+        if stream is not None:
+            text_iter = _iter_stream_text(stream)
+            if tts_config and _tts_config_ready(tts_config):
+                text_iter = _iter_with_speech(text_iter, tts_config, speech_futures)
+            ai_reply = st.write_stream(text_iter)
+        else:
             ai_reply = resp.choices[0].message.content
+            if ai_reply:
+                st.markdown(ai_reply)
+        
+        if ai_reply:
+            _cache_put(_response_cache, cache_key, ai_reply, RESPONSE_CACHE_MAX_ENTRIES,
+                       ttl=RESPONSE_CACHE_TTL_SECONDS)
+        
+        # ストリーミングでない場合は、TTS音声生成をここでバックグラウンド開始する
+        if stream is None and ai_reply and tts_config:
+            speech_futures = start_speech_synthesis(ai_reply, tts_config)
+                
+    except Exception as e:
+        st.error(f"応答生成エラー: {e}")
+        st.warning("💡 考えられる原因:")
+        st.write("1. デプロイメント名が正しくない可能性があります")
+        st.write("2. APIバージョンが対応していない可能性があります")
+        st.write("3. APIキーの権限が不足している可能性があります")
+        st.write(f"4. 使用しようとしたモデル: `{GPT_DEPLOYMENT_NAME}`")
+    
+    return ai_reply, speech_futures
+
+
+@st.fragment
+def render_voice_chat(gpt_client, voice_client, GPT_DEPLOYMENT_NAME, STT_DEPLOYMENT_NAME, tts_config):
+    """
+    音声チャットの入力・送信・応答・履歴表示
+    
+    フラグメントとして実行されるため、テキスト入力や録音・送信などの操作では
+    この部分だけが再実行され、アプリ全体（表示中のページやクライアント取得）は再実行されない。
+    """
+    # 入力UI
+    col1, col2 = st.columns([1, 1])
+    
+    with col1:
+        user_text = render_input_ui()
+    
+    with col2:
+        transcribed_text = handle_voice_input(voice_client, STT_DEPLOYMENT_NAME)
+    
+    # 最終的な入力の決定
+    final_input = handle_text_input(user_text, transcribed_text)
+    
+    # 送信UI
+    send = render_send_button()
+    auto_speak = st.checkbox("🔊 自動読み上げ", key="voice_auto_speak")
+    
+    # チャット履歴表示（これまでのやり取り）
+    display_chat_history(tts_config)
+    
+    # AI応答処理（今回のやり取りだけを履歴の末尾に追加で描画する）
+    if send and final_input and final_input.strip():
+        question = final_input.strip()
+        append_chat_message("user", question)
+        with st.chat_message("user"):
+            st.markdown(question)
+        
+        with st.chat_message("assistant"):
+            # AI応答生成 + TTS音声生成の開始（GPTクライアント使用 - East US 2）
+            # 自動読み上げがオフの場合は音声を生成しない（必要なら履歴から読み上げる）
+            ai_reply, speech_futures = generate_ai_response(
+                gpt_client, GPT_DEPLOYMENT_NAME, final_input, tts_config if auto_speak else None
+            )
             
-            # TTS音声生成
-            if ai_reply and tts_config:
-                with st.spinner("🔊 音声生成中..."):
-                    audio_data = generate_speech(ai_reply, tts_config)
-                    if audio_data:
-                        st.success("✅ 音声生成完了！")
-                    
-        except Exception as e:
-            st.error(f"応答生成エラー: {e}")
-            st.warning("💡 考えられる原因:")
-            st.write("1. デプロイメント名が正しくない可能性があります")
-            st.write("2. APIバージョンが対応していない可能性があります")
-            st.write("3. APIキーの権限が不足している可能性があります")
-            st.write(f"4. 使用しようとしたモデル: `{GPT_DEPLOYMENT_NAME}`")
-    
-    return ai_reply, audio_data
-
-
-def display_chat_history():
-    """チャット履歴の表示"""
-    if st.session_state["voice_agent_messages"]:
-        st.divider()
-        st.caption("📝 チャット履歴")
-        for i, m in enumerate(st.session_state["voice_agent_messages"][-6:]):  # 最新6件のみ表示
-            if m["role"] == "user":
-                st.markdown(f"**👤 あなた:** {m['content']}")
-            elif m["role"] == "assistant":
-                st.markdown(f"**🤖 AI:** {m['content']}")
+            if ai_reply:
+                # 応答本文は generate_ai_response 内でこの吹き出しにストリーミング表示済み
+                append_chat_message("assistant", ai_reply)
+                
+                # 音声再生UI（ストリーミング中からバックグラウンドで音声生成が進む）
+                audio_data = wait_for_speech(speech_futures)
+                if audio_data:
+                    _remember_speech(ai_reply, audio_data)
+                    render_audio_player(audio_data)
+
+
+def display_chat_history(tts_config: dict = None):
+    """チャット履歴の表示（今回送信したやり取りは render_voice_chat が続けて描画する）"""
+    st.divider()
+    st.caption("📝 チャット履歴")
+    _render_chat_history(tts_config)
+
+
+def _render_chat_history(tts_config: dict = None):
+    """
+    最新6件のチャットを表示（応答には読み上げボタンを付ける）
+    
+    render_voice_chat のフラグメント内で描画されるため、アプリ本体のウィジェット操作
+    では再描画されない（フラグメントの入れ子は避ける）。
+    """
+    messages = st.session_state["voice_agent_messages"]
+    start = max(0, len(messages) - CHAT_HISTORY_DISPLAY_MESSAGES)
+    for index in range(start, len(messages)):
+        m = messages[index]
+        if m["role"] in ("user", "assistant"):
+            with st.chat_message(m["role"]):
+                st.markdown(m["content"])
+                # 音声は押されたときだけ生成する（同じ文章は音声キャッシュを再利用）
+                if m["role"] == "assistant" and tts_config:
+                    if st.button("🔊 読み上げ", key=f"speak_message_{index}"):
+                        audio_data = wait_for_speech(start_speech_synthesis(m["content"], tts_config))
+                        if audio_data:
+                            _remember_speech(m["content"], audio_data)
+                            st.audio(audio_data, format="audio/mp3")
 
 
 def render_audio_player(audio_data: bytes):